@@ -1,11 +1,20 @@
+import io
 import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Any, List
 
+import numpy as np
 import pandas as pd
-from docxtpl import DocxTemplate, Subdoc
+from docx.oxml.ns import nsdecls
+from docxtpl import DocxTemplate
 from datetime import datetime
-from unicodedata import normalize, combining
+from functools import lru_cache
+from jinja2 import ChainableUndefined, Environment, Template
+from unicodedata import normalize
+from xml.sax.saxutils import escape
 
 
 # =========================
@@ -15,27 +24,37 @@ EXCEL_PATH = "/absolute/path/to/input.xlsx"
 TEMPLATE_DIR = "/absolute/path/to/templates"  # Thư mục chứa 15 file .docx mẫu
 OUTPUT_DIR = "/absolute/path/to/output"       # Thư mục xuất kết quả
 
+# DataFrame rỗng dùng chung cho khách hàng không có hàng hoá
+EMPTY_ITEMS = pd.DataFrame()
+
 
 # =========================
 # Tiện ích xử lý chuỗi/định dạng
 # =========================
-def strip_accents(text: str) -> str:
-    if not isinstance(text, str):
-        return text
-    return "".join(c for c in normalize("NFD", text) if not combining(c))
+# Bảng translate xoá sẵn các dấu kết hợp (combining marks) sau khi tách
+# NFKD; translate chạy ở tầng C, nhanh hơn nhiều so với lọc từng ký tự
+_COMBINING_TABLE = dict.fromkeys(range(0x0300, 0x0370))
 
 
+@lru_cache(maxsize=4096)
 def normalize_key(text: str) -> str:
     if not isinstance(text, str):
         return text
-    return strip_accents(text).lower().replace(" ", "")
+    # NFKD tách dấu như NFD nhưng quy đổi cả ký tự tương thích (chữ số
+    # full-width, chữ ghép...) mà header Excel hay lẫn vào; casefold so
+    # khớp chặt hơn lower
+    return normalize("NFKD", text).translate(_COMBINING_TABLE).casefold().replace(" ", "")
+
+
+# \w giữ cả chữ có dấu tiếng Việt (unicode) lẫn "_", cộng thêm "-.() []"
+# như bản cũ; sub chạy 1 lượt ở tầng C thay vì duyệt từng ký tự
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w\-.()\[\] ]")
 
 
 def safe_filename(text: str) -> str:
     if not isinstance(text, str):
         text = str(text)
-    keep = "-_.() []"
-    return "".join(ch if ch.isalnum() or ch in keep else "_" for ch in text)
+    return _UNSAFE_FILENAME_RE.sub("_", text)
 
 
 def format_date(value: Any, fmt: str = "%d/%m/%Y") -> str:
@@ -71,17 +90,51 @@ def format_currency(value: Any) -> str:
         return str(value)
 
 
+def format_int_series(s: pd.Series) -> pd.Series:
+    """Bản vector hoá của format_int cho cả cột (1 lần thay vì từng ô)."""
+    num = pd.to_numeric(s, errors="coerce")
+    out = num.map(lambda x: f"{int(round(x)):,}".replace(",", ".") if pd.notna(x) else "")
+    # Giữ nguyên giá trị gốc nếu không chuyển được sang số (giống format_int)
+    bad = num.isna() & s.notna() & (s.astype(str) != "")
+    if bad.any():
+        out[bad] = s[bad].astype(str)
+    return out
+
+
+def format_currency_series(s: pd.Series) -> pd.Series:
+    """Bản vector hoá của format_currency cho cả cột."""
+    num = pd.to_numeric(s, errors="coerce")
+    out = num.map(lambda x: f"{x:,.0f}".replace(",", ".") if pd.notna(x) else "")
+    bad = num.isna() & s.notna() & (s.astype(str) != "")
+    if bad.any():
+        out[bad] = s[bad].astype(str)
+    return out
+
+
 # =========================
 # Đọc Excel
 # =========================
-def find_sheet_names(xlsx_path: str) -> Dict[str, str]:
+def excel_engine() -> str:
+    """
+    Chọn engine đọc Excel: ưu tiên calamine (viết bằng Rust, nhanh hơn
+    openpyxl nhiều lần và tốn ít bộ nhớ hơn), fallback về openpyxl nếu
+    chưa cài python-calamine.
+    """
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl"
+
+
+def find_sheet_names(sheet_names: List[str]) -> Dict[str, str]:
     """
-    Tìm sheet 'Hồ sơ' và 'Hàng hoá' bất kể dấu/viết hoa.
+    Tìm sheet 'Hồ sơ' và 'Hàng hoá' bất kể dấu/viết hoa trong danh sách
+    tên sheet có sẵn (không mở lại workbook).
     Trả về dict {'hoso': real_name, 'hanghoa': real_name}
     """
-    xls = pd.ExcelFile(xlsx_path)
     wanted = {"hoso": None, "hanghoa": None}
-    for s in xls.sheet_names:
+    for s in sheet_names:
         key = normalize_key(s)
         if "hoso" in key and wanted["hoso"] is None:
             wanted["hoso"] = s
@@ -91,14 +144,16 @@ def find_sheet_names(xlsx_path: str) -> Dict[str, str]:
         if "hang" in key and "hoa" in key and wanted["hanghoa"] is None:
             wanted["hanghoa"] = s
     if not wanted["hoso"] or not wanted["hanghoa"]:
-        raise ValueError(f"Không tìm thấy đủ 2 sheet trong file Excel: {xls.sheet_names}")
+        raise ValueError(f"Không tìm thấy đủ 2 sheet trong file Excel: {sheet_names}")
     return wanted
 
 
 def read_excel_data(xlsx_path: str) -> Dict[str, pd.DataFrame]:
-    sheets = find_sheet_names(xlsx_path)
-    df_hoso = pd.read_excel(xlsx_path, sheet_name=sheets["hoso"], dtype={"Mã KH": str})
-    df_hanghoa = pd.read_excel(xlsx_path, sheet_name=sheets["hanghoa"], dtype={"Mã KH": str})
+    # Mở workbook đúng 1 lần, dùng lại cho cả dò tên sheet lẫn đọc dữ liệu
+    with pd.ExcelFile(xlsx_path, engine=excel_engine()) as xls:
+        sheets = find_sheet_names(xls.sheet_names)
+        df_hoso = xls.parse(sheets["hoso"], dtype={"Mã KH": str})
+        df_hanghoa = xls.parse(sheets["hanghoa"], dtype={"Mã KH": str})
 
     # Chuẩn hóa tên cột tối thiểu (giữ nguyên tiếng Việt, chỉ strip spaces)
     df_hoso.columns = [c.strip() if isinstance(c, str) else c for c in df_hoso.columns]
@@ -108,19 +163,59 @@ def read_excel_data(xlsx_path: str) -> Dict[str, pd.DataFrame]:
 
 
 # =========================
-# Tạo Subdoc bảng hàng hoá
+# Tạo XML bảng hàng hoá
 # =========================
-def build_goods_table_subdoc(doc: DocxTemplate, items_df: pd.DataFrame) -> Subdoc:
+def _goods_row_xml(cells: List[str]) -> str:
+    """Sinh XML một dòng bảng (<w:tr>) từ list text đã escape sẵn bằng escape()."""
+    tcs = "".join(
+        f'<w:tc><w:p><w:r><w:t xml:space="preserve">{escape(c)}</w:t></w:r></w:p></w:tc>'
+        for c in cells
+    )
+    return f"<w:tr>{tcs}</w:tr>"
+
+
+# tblPr (style + viền) và dòng tiêu đề không đổi giữa các lần render ->
+# dựng sẵn 1 lần khi import, mỗi bảng chỉ còn ghép các dòng dữ liệu
+_GOODS_HEADERS = ["Tên hàng", "Số lượng", "Đơn giá", "Thành tiền"]
+_GOODS_TBL_PR_XML = (
+    '<w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblBorders>'
+    + "".join(
+        f'<w:{side} w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+        for side in ("top", "left", "bottom", "right", "insideH", "insideV")
+    )
+    + "</w:tblBorders></w:tblPr>"
+)
+# ECMA-376 bắt buộc <w:tblGrid> (1 gridCol mỗi cột) nằm giữa tblPr và
+# dòng đầu tiên; thiếu nó Word coi file là hỏng
+_GOODS_TBL_GRID_XML = "<w:tblGrid>" + "<w:gridCol/>" * len(_GOODS_HEADERS) + "</w:tblGrid>"
+_GOODS_HEADER_XML = _goods_row_xml(_GOODS_HEADERS)
+
+# Khách hàng không có hàng hoá dùng chung 1 chuỗi XML dựng sẵn
+EMPTY_GOODS_XML = "<w:p><w:r><w:t>Không có hàng hoá.</w:t></w:r></w:p>"
+
+
+def _goods_table_xml(rows: List[str]) -> str:
     """
-    Sinh Subdoc bảng hàng hoá để chèn vào {{BảngHàngHoá}}.
-    Yêu cầu template đặt placeholder {{BảngHàngHoá}} trên một dòng riêng.
+    Ghép XML bảng hàng hoá hoàn chỉnh (<w:tbl>) từ các dòng dữ liệu đã
+    sinh sẵn; tblPr và dòng tiêu đề dùng hằng số dựng sẵn ở trên. Dùng
+    tblStyle "TableGrid" + khai báo viền trực tiếp để không phụ thuộc
+    styles.xml của từng template.
     """
-    sd = doc.new_subdoc()
+    return (
+        f"<w:tbl {nsdecls('w')}>{_GOODS_TBL_PR_XML}{_GOODS_TBL_GRID_XML}"
+        f"{_GOODS_HEADER_XML}{''.join(rows)}</w:tbl>"
+    )
 
-    # Không có dòng hàng hoá -> để trống hoặc ghi chú
+
+def build_goods_table_xml(items_df: pd.DataFrame) -> str:
+    """
+    Sinh chuỗi XML bảng hàng hoá để chèn vào {{BảngHàngHoá}}.
+    Yêu cầu template đặt placeholder {{BảngHàngHoá}} trên một dòng riêng
+    (dạng {{p BảngHàngHoá}} để docxtpl thay cả đoạn văn bằng bảng).
+    """
+    # Không có dòng hàng hoá -> dùng ghi chú dựng sẵn
     if items_df is None or items_df.empty:
-        p = sd.add_paragraph("Không có hàng hoá.")
-        return sd
+        return EMPTY_GOODS_XML
 
     # Xác định các cột mong muốn (linh hoạt tên cột)
     # Mặc định: 'Tên hàng', 'Số lượng', 'Đơn giá', 'Thành tiền'
@@ -145,79 +240,143 @@ def build_goods_table_subdoc(doc: DocxTemplate, items_df: pd.DataFrame) -> Subdo
     cols_map["dongia"] = pick_col(items_df, ["Đơn giá", "Don gia", "Đơn Giá", "DonGia"])
     cols_map["thanhtien"] = pick_col(items_df, ["Thành tiền", "Thanh tien", "Thành Tiền", "ThanhTien"])
 
-    # Tính 'Thành tiền' nếu thiếu
-    working = items_df.copy()
-    if cols_map["thanhtien"] is None and cols_map["soluong"] and cols_map["dongia"]:
+    # Tính 'Thành tiền' nếu thiếu: nhân 2 Series cục bộ, không copy frame,
+    # không thêm cột tạm (items_df chỉ đọc, dùng chung giữa các template)
+    tt_series = items_df[cols_map["thanhtien"]] if cols_map["thanhtien"] else None
+    if tt_series is None and cols_map["soluong"] and cols_map["dongia"]:
         try:
-            working["_SoluongNum"] = pd.to_numeric(working[cols_map["soluong"]], errors="coerce").fillna(0)
-            working["_DongiaNum"] = pd.to_numeric(working[cols_map["dongia"]], errors="coerce").fillna(0)
-            working["_ThanhTien"] = working["_SoluongNum"] * working["_DongiaNum"]
-            cols_map["thanhtien"] = "_ThanhTien"
+            sl_num = pd.to_numeric(items_df[cols_map["soluong"]], errors="coerce").fillna(0)
+            dg_num = pd.to_numeric(items_df[cols_map["dongia"]], errors="coerce").fillna(0)
+            tt_series = sl_num * dg_num
         except Exception:
             pass
 
-    # Tạo bảng
-    headers = ["Tên hàng", "Số lượng", "Đơn giá", "Thành tiền"]
-    table = sd.add_table(rows=1, cols=len(headers))
-    table.style = "Table Grid"
-    for i, h in enumerate(headers):
-        table.rows[0].cells[i].text = h
+    # Duyệt theo mảng cột thay vì iterrows() (iterrows tạo một Series mới
+    # cho mỗi dòng, rất chậm khi danh sách hàng hoá dài). Các cột số được
+    # định dạng vector hoá 1 lần cho cả cột thay vì gọi format_* từng ô.
+    n = len(items_df)
 
-    for _, r in working.iterrows():
-        row = table.add_row().cells
+    empty_col = np.full(n, "", dtype=object)
+    if cols_map["ten"]:
+        # where + astype(str): 1 lượt C-level thay cho isna/str từng phần tử
+        ten_series = items_df[cols_map["ten"]]
+        ten_str = ten_series.where(ten_series.notna(), "").astype(str).to_numpy()
+    else:
+        ten_str = empty_col
+    sl_str = format_int_series(items_df[cols_map["soluong"]]).to_numpy() if cols_map["soluong"] else empty_col
+    dg_str = format_currency_series(items_df[cols_map["dongia"]]).to_numpy() if cols_map["dongia"] else empty_col
+    tt_str = format_currency_series(tt_series).to_numpy() if tt_series is not None else empty_col
 
-        ten_val = r[cols_map["ten"]] if cols_map["ten"] in r else ""
-        sl_val = r[cols_map["soluong"]] if cols_map["soluong"] in r else ""
-        dg_val = r[cols_map["dongia"]] if cols_map["dongia"] in r else ""
-        tt_val = r[cols_map["thanhtien"]] if cols_map["thanhtien"] in r else ""
+    # Gom 4 cột đã stringify sẵn thành 1 ma trận n x 4: vòng lặp sinh XML
+    # chỉ còn đọc chuỗi theo chỉ số, không còn convert/guard từng ô
+    rows = np.stack([ten_str, sl_str, dg_str, tt_str], axis=1)
 
-        row[0].text = "" if pd.isna(ten_val) else str(ten_val)
-        row[1].text = format_int(sl_val)
-        row[2].text = format_currency(dg_val)
-        row[3].text = format_currency(tt_val)
+    # Sinh cả bảng dưới dạng chuỗi XML; chuỗi này được Jinja chèn thẳng vào
+    # document.xml khi render, không cần parse lại bằng python-docx
+    xml_rows = [_goods_row_xml(r) for r in rows]
 
-    return sd
+    return _goods_table_xml(xml_rows)
 
 
 # =========================
 # Render 15 template cho mỗi khách hàng
 # =========================
-def build_context_for_customer(doc: DocxTemplate, customer_row: pd.Series, items_df: pd.DataFrame) -> Dict[str, Any]:
+def build_context_for_customer(customer_row: Dict[str, Any], items_df: pd.DataFrame) -> Dict[str, Any]:
     """
-    Tạo context truyền vào docxtpl.render().
-    Các key trùng với placeholder trong Word.
+    Tạo context truyền vào Jinja Template.render().
+    Các key trùng với placeholder trong Word. Giá trị chuỗi được escape
+    sẵn vì kết quả render chèn thẳng vào document.xml.
     """
-    # Đọc các cột chuẩn từ Hồ sơ
-    val = lambda col: ("" if col not in customer_row or pd.isna(customer_row[col]) else customer_row[col])
+    # Đọc các cột chuẩn từ Hồ sơ (customer_row là dict thuần).
+    # NaN/NaT tự khác chính nó -> tránh được pd.isna (dispatch chậm hơn nhiều)
+    def val(col):
+        v = customer_row.get(col)
+        if v is None or v != v:
+            return ""
+        return v
 
     # Mapping cột -> placeholder (điền thêm nếu bạn có nhiều trường hơn trong template)
     ho_ten = val("Họ tên")
-    ngay_sinh = format_date(val("Ngày sinh"))
+    # Ưu tiên cột đã định dạng sẵn trong main(); fallback về format_date
+    # từng giá trị nếu gọi với dữ liệu chưa qua bước chuẩn bị đó
+    if "_NgàySinh_fmt" in customer_row:
+        ngay_sinh = val("_NgàySinh_fmt")
+    else:
+        ngay_sinh = format_date(val("Ngày sinh"))
     dia_chi = val("Địa chỉ")
     so_dt = val("Số điện thoại")
     ma_kh = val("Mã KH")
 
     context = {
-        "TênKH": ho_ten,
-        "NgàySinh": ngay_sinh,
-        "ĐịaChỉ": dia_chi,
-        "SốĐiệnThoại": so_dt,
-        "MãKH": ma_kh,
-        # Bảng hàng hoá sinh động
-        "BảngHàngHoá": build_goods_table_subdoc(doc, items_df),
+        "TênKH": escape(str(ho_ten)),
+        "NgàySinh": escape(str(ngay_sinh)),
+        "ĐịaChỉ": escape(str(dia_chi)),
+        "SốĐiệnThoại": escape(str(so_dt)),
+        "MãKH": escape(str(ma_kh)),
+        # Bảng hàng hoá sinh động (đã là XML hợp lệ, không escape);
+        # khách hàng không có hàng hoá đi thẳng vào hằng số dựng sẵn
+        "BảngHàngHoá": EMPTY_GOODS_XML
+        if items_df is None or items_df.empty
+        else build_goods_table_xml(items_df),
     }
 
     return context
 
 
+def prepare_templates(templates: List[Path]) -> List[tuple]:
+    """
+    Chuẩn bị mỗi template đúng 1 lần: đọc bytes, trích word/document.xml,
+    chạy patch_xml của docxtpl (chuyển {{p ...}}, {%p ...%}... về Jinja
+    chuẩn trên chuỗi XML). Trả về list (path, bytes, src_xml); src_xml là
+    chuỗi nên pickle được sang process con, ở đó nó được biên dịch thành
+    jinja2.Template 1 lần rồi dùng lại cho mọi khách hàng.
+    Lưu ý: chỉ render word/document.xml — placeholder đặt trong
+    header/footer không được hỗ trợ ở đường nhanh này.
+    """
+    prepared = []
+    for p in templates:
+        tpl_bytes = p.read_bytes()
+        doc = DocxTemplate(io.BytesIO(tpl_bytes))
+        with zipfile.ZipFile(io.BytesIO(tpl_bytes)) as z:
+            raw_xml = z.read("word/document.xml").decode("utf-8")
+        prepared.append((p, tpl_bytes, doc.patch_xml(raw_xml)))
+    return prepared
+
+
+# Môi trường Jinja dùng chung cho mọi template: bảng filter/undefined chỉ
+# dựng 1 lần, cache bytecode không giới hạn nên bản biên dịch sống suốt
+# vòng đời process. ChainableUndefined cho phép placeholder lồng thiếu dữ
+# liệu render thành chuỗi rỗng thay vì lỗi.
+_JINJA_ENV = Environment(autoescape=False, undefined=ChainableUndefined, cache_size=-1)
+
+# Cache Template đã biên dịch theo đường dẫn, riêng cho từng process con
+_COMPILED_TEMPLATES: Dict[str, Template] = {}
+
+
+def _get_compiled(key: str, src_xml: str) -> Template:
+    tpl = _COMPILED_TEMPLATES.get(key)
+    if tpl is None:
+        tpl = _COMPILED_TEMPLATES[key] = _JINJA_ENV.from_string(src_xml)
+    return tpl
+
+
+def _write_output(out_path: Path, data: bytes):
+    """Ghi 1 file kết quả (chạy trong thread nền của writer)."""
+    out_path.write_bytes(data)
+    print(f"Đã tạo: {out_path}")
+
+
 def render_templates_for_customer(
-    templates: List[Path],
+    templates: List[tuple],
     output_root: Path,
-    customer_row: pd.Series,
-    items_all: pd.DataFrame,
+    customer_row: Dict[str, Any],
+    items_df: pd.DataFrame,
 ):
     """
     Với 1 khách hàng, render toàn bộ 15 template và lưu ra thư mục con riêng.
+    `templates` là list (path, bytes, src_xml) do prepare_templates() chuẩn
+    bị sẵn. `items_df` là hàng hoá đã lọc sẵn theo Mã KH của khách hàng này.
+    Mọi tham số đều pickle được để có thể chạy trong process con.
     """
     customer_id = customer_row.get("Mã KH", "")
     customer_name = customer_row.get("Họ tên", "")
@@ -225,23 +384,49 @@ def render_templates_for_customer(
     customer_out_dir = output_root / folder_name
     customer_out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Lọc hàng hoá theo Mã KH
-    items_df = pd.DataFrame()
-    if items_all is not None and "Mã KH" in items_all.columns:
-        items_df = items_all[items_all["Mã KH"].astype(str) == str(customer_id)].copy()
-
-    for tpl_path in templates:
-        doc = DocxTemplate(str(tpl_path))
-        context = build_context_for_customer(doc, customer_row, items_df)
-
-        # Render
-        doc.render(context)
-
-        # Xuất file với tên gốc + mã KH
-        out_name = f"{tpl_path.stem}__{safe_filename(str(customer_id))}.docx"
-        out_path = customer_out_dir / out_name
-        doc.save(str(out_path))
-        print(f"Đã tạo: {out_path}")
+    # Context (kể cả XML bảng hàng hoá) giống hệt nhau cho cả 15 template
+    # -> dựng đúng 1 lần cho mỗi khách hàng thay vì trong vòng lặp template
+    context = build_context_for_customer(customer_row, items_df)
+
+    # Ghi file ở thread nền: đẩy (path, bytes) cho writer, để nén zlib +
+    # I/O đĩa chạy chồng lên lần render kế tiếp
+    with ThreadPoolExecutor(max_workers=4) as writer:
+        pending = []
+        for tpl_path, tpl_bytes, src_xml in templates:
+            # Render document.xml bằng Template đã biên dịch sẵn (không
+            # dựng lại cây docxtpl cho từng lần render)
+            rendered_xml = _get_compiled(str(tpl_path), src_xml).render(context)
+
+            # Vá document.xml mới vào bản sao zip của template gốc
+            buf = io.BytesIO()
+            with zipfile.ZipFile(io.BytesIO(tpl_bytes)) as z_in, \
+                    zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z_out:
+                for item in z_in.infolist():
+                    if item.filename == "word/document.xml":
+                        z_out.writestr(item, rendered_xml)
+                    else:
+                        z_out.writestr(item, z_in.read(item.filename))
+
+            # Xuất file với tên gốc + mã KH
+            out_name = f"{tpl_path.stem}__{safe_filename(str(customer_id))}.docx"
+            out_path = customer_out_dir / out_name
+            pending.append(writer.submit(_write_output, out_path, buf.getvalue()))
+
+        # Lấy kết quả từng future để lỗi ghi file (đầy đĩa, thiếu quyền...)
+        # nổi lên khỏi process con thay vì bị nuốt im lặng
+        for fut in pending:
+            fut.result()
+
+
+def _render_one(payload: tuple):
+    """Điểm vào cho process con: unpack payload rồi render 1 khách hàng."""
+    templates, output_root, customer_row, items_df = payload
+    render_templates_for_customer(
+        templates=templates,
+        output_root=output_root,
+        customer_row=customer_row,
+        items_df=items_df,
+    )
 
 
 def main():
@@ -262,6 +447,9 @@ def main():
         raise FileNotFoundError(f"Không tìm thấy template .docx trong {template_dir}")
     print(f"Tìm thấy {len(templates)} template(s).")
 
+    # Đọc + patch sẵn template 1 lần, tránh parse lại cho từng khách hàng
+    template_data = prepare_templates(templates)
+
     # Đọc Excel
     data = read_excel_data(str(xlsx_path))
     df_hoso = data["hoso"]
@@ -273,14 +461,34 @@ def main():
         if col not in df_hoso.columns:
             raise ValueError(f"Sheet 'Hồ sơ' thiếu cột bắt buộc: {col}")
 
-    # Duyệt từng khách hàng
-    for idx, row in df_hoso.iterrows():
-        render_templates_for_customer(
-            templates=templates,
-            output_root=output_dir,
-            customer_row=row,
-            items_all=df_hanghoa,
-        )
+    # Định dạng 'Ngày sinh' vector hoá 1 lần cho cả cột: to_datetime theo
+    # scalar chậm hơn cả trăm lần so với 1 lần convert cả cột
+    if "Ngày sinh" in df_hoso.columns:
+        raw = df_hoso["Ngày sinh"]
+        parsed = pd.to_datetime(raw, errors="coerce")
+        fallback = raw.where(raw.notna(), "").astype(str)
+        df_hoso["_NgàySinh_fmt"] = parsed.dt.strftime("%d/%m/%Y").where(parsed.notna(), fallback)
+
+    # Gom nhóm hàng hoá theo Mã KH một lần duy nhất: tra dict O(1) thay vì
+    # quét + astype(str) toàn bộ df_hanghoa cho từng khách hàng. Chuyển
+    # cột mã sang categorical để groupby băm theo mã số nguyên thay vì
+    # băm từng chuỗi Python (nhanh hơn, ít cấp phát hơn).
+    items_by_kh = {}
+    if "Mã KH" in df_hanghoa.columns:
+        df_hanghoa["Mã KH"] = df_hanghoa["Mã KH"].astype(str).astype("category")
+        items_by_kh = dict(iter(df_hanghoa.groupby("Mã KH", observed=True, sort=False)))
+
+    # Chuẩn bị payload cho từng khách hàng: chuyển cả frame thành list dict
+    # 1 lần, mọi truy cập trường sau đó là dict lookup thuần
+    payloads = []
+    for rec in df_hoso.to_dict(orient="records"):
+        customer_id = str(rec.get("Mã KH", ""))
+        items_df = items_by_kh.get(customer_id, EMPTY_ITEMS)
+        payloads.append((template_data, output_dir, rec, items_df))
+
+    # Mỗi khách hàng render độc lập (thư mục riêng) -> chạy song song theo process
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        list(ex.map(_render_one, payloads))
 
     print("Hoàn thành tất cả.")
 